@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""Measures decode-validate-dispatch throughput of the kernel's message loop,
+per message type, without a broker or an executor in the way. Run it from
+the root of a checkout:
+
+    python -m benchmarks.dispatch_benchmark [iterations]
+"""
+
+from plutoid_kernel.dispatch import MessageDispatcher, KERNEL_MESSAGE_TYPES
+from plutoid_kernel.utils import form_message
+import json
+import sys
+import time
+import uuid
+
+
+DEFAULT_ITERATIONS = 100000
+
+
+def build_messages(kernel_id):
+    reverse_path = str(uuid.uuid4())
+    return {
+        'ping_request': form_message(kernel_id, 'ping_request', {'reverse_path': reverse_path}),
+        'code_execution': form_message(kernel_id, 'code_execution', {'reverse_path': reverse_path, 'code': 'i = 2'}),
+        'input_response': form_message(kernel_id, 'input_response', {'content': 'xyz'}),
+        'stdin_data': form_message(kernel_id, 'stdin_data', {'content': 'x\ny\n'}),
+        'invalid': {'header': {'kernel_id': kernel_id}},
+    }
+
+
+def build_dispatcher():
+    dispatcher = MessageDispatcher()
+    noop = lambda message: None
+    for msg_type, required_data_fields in KERNEL_MESSAGE_TYPES:
+        dispatcher.register(msg_type, noop, required_data_fields)
+    return dispatcher
+
+
+def run(dispatcher, raw_message, iterations):
+    validate = dispatcher.validate
+    dispatch = dispatcher.dispatch
+    loads = json.loads
+
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        message = loads(raw_message)
+        if validate(message):
+            dispatch(message)
+
+    return iterations / (time.perf_counter() - start_time)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ITERATIONS
+    dispatcher = build_dispatcher()
+
+    for msg_type, message in build_messages(str(uuid.uuid4())).items():
+        rate = run(dispatcher, json.dumps(message), iterations)
+        print('%-16s %12.0f msgs/sec' % (msg_type, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+HEADER_FIELDS = frozenset(['kernel_id', 'msg_id', 'msg_type', 'timestamp'])
+
+# Message types the kernel handles, with the msg_data fields each one needs.
+# Kernel registers handle_<msg_type> for every entry.
+KERNEL_MESSAGE_TYPES = [
+    ('ping_request', ['reverse_path']),
+    ('code_execution', ['reverse_path', 'code']),
+    ('input_response', ['content']),
+    ('stdin_data', ['content']),
+    ('shutdown', []),
+]
+
+
+class MessageDispatcher(object):
+    """Registry of message handlers keyed on msg_type. Each entry carries the
+    msg_data fields its handler needs, so validation is a couple of set
+    comparisons and dispatch is a single dict lookup."""
+
+    def __init__(self):
+        self.handlers = {}
+
+
+    def register(self, msg_type, handler, required_data_fields=()):
+        self.handlers[msg_type] = (handler, frozenset(required_data_fields))
+
+
+    def validate(self, message):
+        """Returns the msg_type of a well formed message, None otherwise."""
+        if type(message) is not dict: return None
+
+        header = message.get('header')
+        if type(header) is not dict or not HEADER_FIELDS <= header.keys(): return None
+
+        msg_type = header['msg_type']
+        if type(msg_type) is not str or not msg_type: return None
+
+        entry = self.handlers.get(msg_type)
+        if entry and entry[1]:
+            msg_data = message.get('msg_data')
+            if type(msg_data) is not dict or not entry[1] <= msg_data.keys(): return None
+
+        return msg_type
+
+
+    def dispatch(self, message):
+        msg_type = message['header']['msg_type']
+        entry = self.handlers.get(msg_type)
+        if not entry:
+            logger.warning('Received message of unknown type %s with id %s' % (msg_type, message['header']['msg_id']))
+            return
+
+        entry[0](message)
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
-from .messaging import get_messages, send_message, ack_message
+from .messaging import get_messages, send_message, ack_message, disconnected_time
 from .utils import form_message
+from .dispatch import MessageDispatcher, KERNEL_MESSAGE_TYPES
 import json
+from collections import deque
 from datetime import datetime
 from plutoid import Executor
 from blinker import signal as blinker_signal
@@ -23,12 +25,16 @@ class KernelState(object):
 
         self.cmds_in_progress = []
         self.last_ping_request_timestamp = datetime.now()
+        self.last_ping_disconnected_time = disconnected_time()
 
         self.code_execution_revese_path = None
         self.code_execution_msg_id = None
         self.code_execution_start_time = 0
 
+        self.input_request_msg_id = None
         self.last_input_response = None
+        self.stdin_lines = deque()
+        self.stdin_partial_line = ''
 
         self.pending_stdout_chunks = []
         self.pending_stderr_chunks = []
@@ -40,9 +46,37 @@ class KernelState(object):
         self.code_execution_revese_path = None
         self.code_execution_msg_id = None
         self.code_execution_start_time = 0
+        self.input_request_msg_id = None
+        self.last_input_response = None
+        self.stdin_lines.clear()
+        self.stdin_partial_line = ''
         self.pending_stdout_chunks = []
         self.pending_stderr_chunks = []
 
+
+    def buffer_stdin(self, content, eof=True):
+        """Queue lines to be served to input(), splitting on universal newlines
+        like input() does. Unless `eof` is set, an unterminated last line is
+        held back until the next chunk completes it."""
+        if not isinstance(content, str):
+            logger.warning('Ignoring stdin of type %s' % type(content).__name__)
+            return
+
+        text = self.stdin_partial_line + content
+
+        # A trailing \r may be the first half of a \r\n split across chunks.
+        held_back = ''
+        if not eof and text.endswith('\r'):
+            text, held_back = text[:-1], '\r'
+
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        self.stdin_partial_line = lines.pop() + held_back
+        if eof and self.stdin_partial_line:
+            lines.append(self.stdin_partial_line)
+            self.stdin_partial_line = ''
+
+        self.stdin_lines.extend(lines)
+
     
     def mark_in_progress(self, cmd):
         self.cmds_in_progress.append(cmd)
@@ -76,33 +110,55 @@ class Kernel(object):
         self.kernel_state = KernelState(self.kernel_id)
         self.executor = Executor(self.fetch_input, self.max_code_execution_time)
 
+        self.dispatcher = MessageDispatcher()
+        for msg_type, required_data_fields in KERNEL_MESSAGE_TYPES:
+            self.register_message_handler(msg_type, getattr(self, 'handle_' + msg_type), required_data_fields)
+
         blinker_signal('plutoid::stdout').connect(self.publish_stdout)
         blinker_signal('plutoid::stderr').connect(self.publish_stderr)
         blinker_signal('plutoid::matplotlib').connect(self.publish_matplotlib)
 
 
+    def register_message_handler(self, msg_type, handler, required_data_fields=()):
+        self.dispatcher.register(msg_type, handler, required_data_fields)
+
+
     def fetch_input(self, prompt):
+        if self.kernel_state.stdin_lines:
+            # Behave like input() on piped stdin: the prompt goes to stdout.
+            self.publish_stdout(self, prompt)
+            return self.kernel_state.stdin_lines.popleft()
+
         response = form_message(self.kernel_id, 'input_request',
                         {'in_response_to': self.kernel_state.code_execution_msg_id,
                          'prompt': prompt})
 
+        self.kernel_state.input_request_msg_id = response['header']['msg_id']
+        self.kernel_state.last_input_response = None
         send_message(self.kernel_state.code_execution_revese_path, json.dumps(response))
 
         self.kernel_state.mark_in_progress('input_request')
-        self.fetch_and_process_messages(valid_msg_types=['input_response', 'shutdown'], 
-            awaited_msg_type='input_response', duration=self.input_timeout)
+        self.fetch_and_process_messages(valid_msg_types=['input_response', 'stdin_data', 'shutdown'],
+            until=self.has_input, duration=self.input_timeout)
         self.kernel_state.mark_not_in_progress('input_request')
+        self.kernel_state.input_request_msg_id = None
 
         if self.kernel_state.last_input_response:
             content = self.kernel_state.last_input_response['msg_data']['content']
             self.kernel_state.last_input_response = None
+        elif self.kernel_state.stdin_lines:
+            content = self.kernel_state.stdin_lines.popleft()
         else:
-            logger.warn('Did not receive input_response.')
+            logger.warning('Did not receive input_response.')
             content = ''
 
         return content
         
 
+    def has_input(self):
+        return self.kernel_state.last_input_response is not None or bool(self.kernel_state.stdin_lines)
+
+
     def publish_stdout(self, sender, content):
         self.publish_output('stdout', sender, content)
 
@@ -115,7 +171,7 @@ class Kernel(object):
         if not content: return
 
         if not self.kernel_state.is_executing_code():
-            logger.warn('Side effect %s observed while not executing code')
+            logger.warning('Side effect %s observed while not executing code')
             return
 
         if stdout_or_stderr == 'stdout':
@@ -144,7 +200,7 @@ class Kernel(object):
 
     def publish_matplotlib(self, sender, mimetype, content):
         if not self.kernel_state.is_executing_code():
-            logger.warn('Side effect matplotlib observed while not executing code')
+            logger.warning('Side effect matplotlib observed while not executing code')
             return
 
         logger.info('Publishing side effect of type matplotlib')
@@ -159,30 +215,25 @@ class Kernel(object):
 
 
     def handle_ping_request(self, message):
-        if 'msg_data' not in message or 'reverse_path' not in message['msg_data']:
-            logger.warn('Invalid ping request: %s' % json.dumps(message))
-            return
-
         response = form_message(self.kernel_id, 'ping_response',
                         {'in_response_to': message['header']['msg_id']})
 
         send_message(message['msg_data']['reverse_path'], json.dumps(response))
 
         self.kernel_state.last_ping_request_timestamp = datetime.now()
+        self.kernel_state.last_ping_disconnected_time = disconnected_time()
 
 
     def handle_code_execution(self, message):
-        if 'msg_data' not in message or 'reverse_path' not in message['msg_data'] or 'code' not in message['msg_data']:
-            logger.warn('Invalid code execution message: %s' % json.dumps(message))
-            return
-
         if self.kernel_state.is_in_progress('code_execution'):
-            logger.warn('Received code execution message while already executing code: %s' % json.dumps(message))
+            logger.warning('Received code execution message %s while already executing code' % message['header']['msg_id'])
             return
 
         self.kernel_state.code_execution_revese_path = message['msg_data']['reverse_path']
         self.kernel_state.code_execution_msg_id = message['header']['msg_id']
         self.kernel_state.mark_in_progress('code_execution')
+        if 'stdin' in message['msg_data']:
+            self.kernel_state.buffer_stdin(message['msg_data']['stdin'])
 
         code = message['msg_data']['code']
         self.executor.exec_code(code)
@@ -194,7 +245,29 @@ class Kernel(object):
             self.shutdown()
 
 
-    def handle_shutdown(self):
+    def handle_input_response(self, message):
+        in_response_to = message['msg_data'].get('in_response_to')
+        if not self.kernel_state.is_awaiting_input() \
+                or in_response_to not in (None, self.kernel_state.input_request_msg_id):
+            logger.warning('Dropping input_response %s that does not answer the pending input_request'
+                           % message['header']['msg_id'])
+            return
+
+        self.kernel_state.last_input_response = message
+
+
+    def handle_stdin_data(self, message):
+        in_response_to = message['msg_data'].get('in_response_to')
+        if not self.kernel_state.is_executing_code() \
+                or in_response_to not in (None, self.kernel_state.code_execution_msg_id):
+            logger.warning('Dropping stdin_data %s that does not belong to the running code_execution'
+                           % message['header']['msg_id'])
+            return
+
+        self.kernel_state.buffer_stdin(message['msg_data']['content'], eof=message['msg_data'].get('eof') is True)
+
+
+    def handle_shutdown(self, message):
         self.shutdown()
 
     
@@ -211,49 +284,42 @@ class Kernel(object):
         logger.info('Kernel with id %s exiting.' % self.kernel_id)
 
 
-    def fetch_and_process_messages(self, valid_msg_types=None, awaited_msg_type=None, duration=0):
-        if awaited_msg_type:
-            received_awaited_message = False
-        else:
-            received_awaited_message = True
+    def fetch_and_process_messages(self, valid_msg_types=None, until=None, duration=0):
+        if valid_msg_types:
+            valid_msg_types = frozenset(valid_msg_types)
 
         loop_start_time = datetime.now()
+        deferred_messages = []
 
         while True:
-            ping_messages = []
-            non_ping_messages = []
-
             messages = get_messages(self.kernel_id, timeout=DEFAULT_MESSAGING_TIMEOUT)
             logger.debug('Received %d messages.' % len(messages))
 
-            for queue_name, system_message_id, message in messages:
-                message = json.loads(message)
+            # Pings are answered as they are decoded; everything else waits
+            # until the whole batch has been acked.
+            for queue_name, system_message_id, raw_message in messages:
+                message = json.loads(raw_message)
                 ack_message(system_message_id)
 
-                if not self.is_valid_message(message):
-                    logger.warn('Recevied invalid message: %s' % json.dumps(message))
+                msg_type = self.dispatcher.validate(message)
+                if not msg_type:
+                    logger.warning('Received invalid message: %s' % raw_message)
                     continue
 
-                msg_type = message['header']['msg_type']
                 if msg_type == 'ping_request':
-                    ping_messages.append(message)
+                    self.process_message(message)
                 elif not valid_msg_types or msg_type in valid_msg_types:
-                    non_ping_messages.append(message)
+                    deferred_messages.append(message)
                 else:
-                    logger.warn('Invalid message type for the current state: %s' % json.dumps(message))
+                    logger.warning('Invalid message type %s for the current state.' % msg_type)
 
-                if awaited_msg_type and msg_type == awaited_msg_type:
-                    received_awaited_message = True
-
-            for message in ping_messages:
-                self.process_message(message)
-
-            for message in non_ping_messages:
+            for message in deferred_messages:
                 self.process_message(message)
+            del deferred_messages[:]
 
             self.validate_ping_timeout()
 
-            if awaited_msg_type and received_awaited_message:
+            if until and until():
                 break
 
             if duration and (datetime.now() - loop_start_time).total_seconds() > duration:
@@ -261,9 +327,12 @@ class Kernel(object):
 
     
     def validate_ping_timeout(self):
+        # Clients can't reach us while the broker is down, so time spent
+        # disconnected doesn't count towards the ping timeout.
         ping_delta = (datetime.now() - self.kernel_state.last_ping_request_timestamp).total_seconds()
+        ping_delta -= disconnected_time() - self.kernel_state.last_ping_disconnected_time
         if ping_delta > 2*self.ping_interval:
-            logger.warn('Did not receive ping for %d seconds.' % ping_delta)
+            logger.warning('Did not receive ping for %d seconds.' % ping_delta)
             self.shutdown()
         else:
             logger.debug('%d secodns before ping timeout.' % (2*self.ping_interval - ping_delta))
@@ -274,16 +343,7 @@ class Kernel(object):
 
         logger.info('Processing message of type %s' % msg_type)
 
-        if msg_type == 'ping_request':
-            self.handle_ping_request(message)
-        elif msg_type == 'code_execution':
-            self.handle_code_execution(message)
-        elif msg_type == 'input_response':
-            self.kernel_state.last_input_response = message
-        elif msg_type == 'shutdown':
-            self.handle_shutdown()
-        else:
-            logger.warn('Received message of unknown type: %s' % json.dumps(message))
+        self.dispatcher.dispatch(message)
 
 
     def send_code_execution_complete(self):
@@ -292,14 +352,4 @@ class Kernel(object):
                          'stdout': ''.join(self.kernel_state.pending_stdout_chunks),
                          'stderr': ''.join(self.kernel_state.pending_stderr_chunks)})
 
-        send_message(self.kernel_state.code_execution_revese_path, json.dumps(response))
-
-
-    def is_valid_message( self, message):
-        if 'header' not in message: return False
-
-        header = message['header']
-        for field in ['kernel_id', 'msg_id', 'msg_type', 'timestamp']:
-            if field not in header: return False
-
-        return True
\ No newline at end of file
+        send_message(self.kernel_state.code_execution_revese_path, json.dumps(response))
\ No newline at end of file
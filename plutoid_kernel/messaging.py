@@ -1,28 +1,366 @@
 #!/usr/bin/env python3
 
-from pydisque.client import Client as DisqueClient
+from pydisque.client import Client as DisqueClient, Node as DisqueNode
+from redis import Redis
+from redis.exceptions import ResponseError
+from collections import Counter, deque
 import logging
+import random
+import time
 
 logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_PENDING_MESSAGES = 1000
+
+CONNECT_TIMEOUT = 2
+MAX_GETJOB_TIMEOUT = 10
+SOCKET_TIMEOUT = MAX_GETJOB_TIMEOUT + 5
+
+RECONNECT_BASE_DELAY = 0.1
+RECONNECT_MAX_DELAY = 10
+
+# Error replies that mean the node can't serve us right now, as opposed to
+# rejecting the command itself.
+TRANSIENT_ERRORS = ('NOREPL', 'PAUSE', 'LOADING')
+
+LOCALITY_WINDOW = 100
+LOCALITY_CHECK_INTERVAL = 20
+
+servers = []
 disque_client = None
+connected_server = None
+
+reconnect_attempts = 0
+next_reconnect_time = 0
+
+disconnected_since = None
+total_disconnected_time = 0
+
+pending_messages = deque(maxlen=DEFAULT_MAX_PENDING_MESSAGES)
+pending_acks = deque(maxlen=DEFAULT_MAX_PENDING_MESSAGES)
+
+recent_job_producers = deque(maxlen=LOCALITY_WINDOW)
+jobs_since_locality_check = 0
+
+
+class BrokerUnavailable(Exception):
+    pass
+
+
+class BrokerRejected(Exception):
+    pass
+
+
+class DisqueConnection(DisqueClient):
+    """pydisque client bound to a single node. Sockets carry timeouts so a
+    blackholed broker surfaces as an error instead of blocking forever, and
+    commands are not retried here since failover is handled by this module."""
+
+    def __init__(self, server):
+        DisqueClient.__init__(self, [format_server(server)])
+        self.server = server
+
+
+    def connect(self):
+        host, port = self.server
+        connection = Redis(host, port, socket_timeout=SOCKET_TIMEOUT, socket_connect_timeout=CONNECT_TIMEOUT)
+        node_id = connection.execute_command('HELLO')[1]
+        self.connected_node = DisqueNode(node_id, host, port, connection)
+        self.nodes[format_server(self.server)] = self.connected_node
+
+
+    def execute_command(self, *args, **kwargs):
+        return self.get_connection().execute_command(*args, **kwargs)
+
+
+    def close(self):
+        if self.connected_node:
+            self.connected_node.connection.connection_pool.disconnect()
+
+
+def init(disque_servers=(("localhost",7711),), max_pending_messages=DEFAULT_MAX_PENDING_MESSAGES):
+    global servers, connected_server, reconnect_attempts, next_reconnect_time
+    global disque_client, pending_messages, pending_acks, jobs_since_locality_check
+    global disconnected_since, total_disconnected_time
+
+    if disque_client is not None:
+        close_client(disque_client)
+        disque_client = None
+
+    servers = [(host, int(port)) for host, port in disque_servers]
+    connected_server = None
+    reconnect_attempts = 0
+    next_reconnect_time = 0
+    disconnected_since = time.time()
+    total_disconnected_time = 0
+
+    pending_messages = deque(maxlen=max_pending_messages)
+    pending_acks = deque(maxlen=max_pending_messages)
+
+    recent_job_producers.clear()
+    jobs_since_locality_check = 0
+
+    logger.info('Connecting to disque servers: %s' % ', '.join(format_server(s) for s in servers))
+
+    if not connect():
+        logger.warning('Could not connect to any disque server. Will keep retrying.')
+
+
+def format_server(server):
+    return "%s:%d" % server
+
+
+def is_connected():
+    return disque_client is not None
+
+
+def disconnected_time():
+    """Seconds spent without a broker connection since init, including the
+    current outage."""
+    if disconnected_since is None:
+        return total_disconnected_time
+
+    return total_disconnected_time + time.time() - disconnected_since
+
+
+def open_client(server):
+    client = DisqueConnection(server)
+    try:
+        client.connect()
+    except Exception as e:
+        logger.warning('Could not connect to disque server %s: %s' % (format_server(server), e))
+        close_client(client)
+        return None
+
+    return client
+
+
+def close_client(client):
+    try:
+        client.close()
+    except Exception as e:
+        logger.debug('Error while closing disque connection: %s' % e)
+
+
+def use_client(client, server):
+    global disque_client, connected_server, reconnect_attempts, next_reconnect_time
+    global disconnected_since, total_disconnected_time
 
-def init(disque_servers=(("localhost",7711),)):
-    disque_servers = ["%s:%d" % disque_server for disque_server in disque_servers]
+    if disque_client is not None:
+        close_client(disque_client)
 
-    logger.info('Connecting to disque servers: %s' % ', '.join(disque_servers))
+    if disconnected_since is not None:
+        total_disconnected_time += time.time() - disconnected_since
+        disconnected_since = None
+
+    disque_client = client
+    connected_server = server
+    reconnect_attempts = 0
+    next_reconnect_time = 0
+    logger.info('Connected to disque server %s' % format_server(server))
+
+    flush_pending()
+
+
+def connect():
+    """Connect to the first reachable configured server. The last connected
+    server, which is usually the one that just failed, is tried last."""
+    candidates = [s for s in servers if s != connected_server]
+    if connected_server:
+        candidates.append(connected_server)
+
+    for server in candidates:
+        client = open_client(server)
+        if client:
+            use_client(client, server)
+            return True
+
+    return False
+
+
+def mark_disconnected(error):
+    global disque_client, disconnected_since
+    if disque_client is not None:
+        logger.warning('Lost connection to disque server %s: %s' % (format_server(connected_server), error))
+        close_client(disque_client)
+        disconnected_since = time.time()
+    disque_client = None
+
+
+def reconnect():
+    """Attempt to reconnect if the backoff period has elapsed. Returns whether
+    a connection is available afterwards."""
+    global reconnect_attempts, next_reconnect_time
+
+    if is_connected(): return True
+    if time.time() < next_reconnect_time: return False
+
+    if connect(): return True
+
+    # Full jitter: sleep a random amount up to the exponential ceiling, so a
+    # fleet of kernels that lost the same broker doesn't reconnect in lockstep.
+    ceiling = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** reconnect_attempts)
+    reconnect_attempts += 1
+    next_reconnect_time = time.time() + random.uniform(0, ceiling)
+    logger.warning('Reconnect attempt %d failed. Retrying in %.2f seconds.'
+                   % (reconnect_attempts, next_reconnect_time - time.time()))
+
+    return False
+
+
+def execute(fn, *args, **kwargs):
+    """Run a client method on the current connection. Raises BrokerRejected
+    when the server refuses the command and BrokerUnavailable, after dropping
+    the connection, for transient error replies and everything else."""
+    if not is_connected():
+        raise BrokerUnavailable()
+
+    try:
+        return fn(disque_client, *args, **kwargs)
+    except ResponseError as e:
+        if not str(e).startswith(TRANSIENT_ERRORS):
+            raise BrokerRejected(e)
+
+        mark_disconnected(e)
+        raise BrokerUnavailable(e)
+    except Exception as e:
+        mark_disconnected(e)
+        raise BrokerUnavailable(e)
+
+
+def flush_pending():
+    try:
+        if pending_acks:
+            try:
+                execute(DisqueClient.ack_job, *pending_acks)
+            except BrokerRejected as e:
+                logger.warning('Dropping %d acks rejected by disque: %s' % (len(pending_acks), e))
+            pending_acks.clear()
+
+        while pending_messages:
+            queue_name, message = pending_messages[0]
+            try:
+                execute(DisqueClient.add_job, queue_name, message)
+            except BrokerRejected as e:
+                logger.warning('Dropping message to queue %s rejected by disque: %s' % (queue_name, e))
+            pending_messages.popleft()
+    except BrokerUnavailable:
+        pass
+
+
+def buffer(pending, item, kind):
+    if len(pending) == pending.maxlen:
+        logger.warning('Pending %s buffer is full. Dropping the oldest entry.' % kind)
+    pending.append(item)
+
+
+def record_job_producers(messages):
+    """Track which node produced the jobs we receive and move to the node that
+    produced most of them recently, so GETJOB is served locally."""
+    global jobs_since_locality_check
+
+    for queue_name, system_message_id, message in messages:
+        if isinstance(system_message_id, bytes):
+            system_message_id = system_message_id.decode()
+        # Disque job ids look like D-<first 8 chars of node id>-<random>-<ttl>
+        parts = system_message_id.split('-')
+        if len(parts) > 2:
+            recent_job_producers.append(parts[1])
+
+    jobs_since_locality_check += len(messages)
+    if jobs_since_locality_check < LOCALITY_CHECK_INTERVAL: return
+    jobs_since_locality_check = 0
+
+    if not recent_job_producers: return
+
+    producer, count = Counter(recent_job_producers).most_common(1)[0]
+    if count * 2 <= len(recent_job_producers): return
+
+    node_id = disque_client.connected_node.node_id
+    if isinstance(node_id, bytes):
+        node_id = node_id.decode()
+    if node_id.startswith(producer): return
+
+    # Start a fresh window whatever the outcome, so a producer we can't switch
+    # to doesn't cost a HELLO on every check.
+    recent_job_producers.clear()
+
+    try:
+        hello = execute(DisqueClient.hello)
+    except (BrokerUnavailable, BrokerRejected):
+        return
+
+    for node in hello[2:]:
+        node_id, host, port = [x.decode() if isinstance(x, bytes) else x for x in node[:3]]
+        if not node_id.startswith(producer): continue
+
+        server = (host, int(port))
+        if server not in servers:
+            logger.debug('Node %s producing most jobs is not a configured server.' % format_server(server))
+            return
+
+        logger.info('Most recent jobs were produced by %s. Switching to it.' % format_server(server))
+        client = open_client(server)
+        if client:
+            use_client(client, server)
+        return
 
-    global disque_client
-    disque_client = DisqueClient(disque_servers)
-    disque_client.connect()
 
 def get_messages(queue_name, timeout):
     logger.info('Getting messages from queue %s with timeout %d' % (queue_name, timeout))
-    return disque_client.get_job([queue_name], timeout=timeout*1000)
+
+    if not reconnect():
+        # Keep the caller's polling cadence while the broker is unreachable.
+        time.sleep(max(0, min(timeout, next_reconnect_time - time.time())))
+        return []
+
+    # The socket timeout has to outlast a blocking GETJOB.
+    timeout = min(timeout, MAX_GETJOB_TIMEOUT)
+
+    try:
+        messages = execute(DisqueClient.get_job, [queue_name], timeout=timeout*1000)
+    except BrokerUnavailable:
+        return []
+    except BrokerRejected as e:
+        logger.warning('Getting messages from queue %s rejected by disque: %s' % (queue_name, e))
+        return []
+
+    if messages:
+        record_job_producers(messages)
+
+    return messages
+
 
 def send_message(queue_name, message):
     logger.info('Sending message to queue %s' % queue_name)
-    disque_client.add_job(queue_name, message)
+
+    if reconnect() and not pending_messages:
+        try:
+            execute(DisqueClient.add_job, queue_name, message)
+            return
+        except BrokerUnavailable:
+            pass
+        except BrokerRejected as e:
+            logger.warning('Dropping message to queue %s rejected by disque: %s' % (queue_name, e))
+            return
+
+    buffer(pending_messages, (queue_name, message), 'message')
+    if reconnect():
+        flush_pending()
+
 
 def ack_message(system_message_id):
     logger.debug('Acking message id %s' % system_message_id)
-    disque_client.ack_job(system_message_id)
\ No newline at end of file
+
+    if reconnect():
+        try:
+            execute(DisqueClient.ack_job, system_message_id)
+            return
+        except BrokerUnavailable:
+            pass
+        except BrokerRejected as e:
+            logger.warning('Dropping ack of %s rejected by disque: %s' % (system_message_id, e))
+            return
+
+    buffer(pending_acks, system_message_id, 'ack')
@@ -2,7 +2,7 @@
 
 import click
 from plutoid_kernel.kernel import Kernel
-from plutoid_kernel.messaging import init as init_messaging
+from plutoid_kernel.messaging import init as init_messaging, DEFAULT_MAX_PENDING_MESSAGES
 import logging
 import logging.config
 
@@ -51,15 +51,16 @@ def setup_logging(verbose, logdir):
 @click.option('--logdir')
 @click.option('--session-mode', is_flag=True)
 @click.option('--disque-server', multiple=True, type=(str, int), default=(('localhost', 7711),))
+@click.option('--max-pending-messages', default=DEFAULT_MAX_PENDING_MESSAGES, type=click.IntRange(1))
 @click.option('--ping-interval', default=15)
 @click.option('--input-timeout', default=600)
 @click.option('--max-code-execution-time', default=15)
-def main(kernel_id, verbose, logdir, session_mode, disque_server, ping_interval, input_timeout, max_code_execution_time):
+def main(kernel_id, verbose, logdir, session_mode, disque_server, max_pending_messages, ping_interval, input_timeout, max_code_execution_time):
     setup_logging(verbose, logdir)
 
     logger.info('Starting plutoid kernel...')
 
-    init_messaging(disque_server)
+    init_messaging(disque_server, max_pending_messages)
 
     kernel = Kernel(kernel_id, session_mode, ping_interval, input_timeout, max_code_execution_time)
     kernel.start()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import pytest
+import logging
+from plutoid_kernel.dispatch import MessageDispatcher, KERNEL_MESSAGE_TYPES
+from plutoid_kernel.kernel import Kernel
+from plutoid_kernel.utils import form_message
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = MessageDispatcher()
+    for msg_type, required_data_fields in KERNEL_MESSAGE_TYPES:
+        dispatcher.register(msg_type, lambda message: None, required_data_fields)
+    return dispatcher
+
+
+def test_valid_message(dispatcher):
+    message = form_message('k', 'ping_request', {'reverse_path': 'c'})
+    assert dispatcher.validate(message) == 'ping_request'
+
+
+@pytest.mark.parametrize('field', ['kernel_id', 'msg_id', 'msg_type', 'timestamp'])
+def test_missing_header_field(dispatcher, field):
+    message = form_message('k', 'shutdown')
+    del message['header'][field]
+    assert dispatcher.validate(message) is None
+
+
+@pytest.mark.parametrize('message', [None, [], {}, {'header': []}])
+def test_malformed_message(dispatcher, message):
+    assert dispatcher.validate(message) is None
+
+
+@pytest.mark.parametrize('msg_type', [['ping_request'], {'a': 1}, 0, ''])
+def test_non_string_msg_type(dispatcher, msg_type):
+    message = form_message('k', 'shutdown')
+    message['header']['msg_type'] = msg_type
+    assert dispatcher.validate(message) is None
+
+
+@pytest.mark.parametrize('msg_data', [{}, {'reverse_path': 'c'}, None, 'code'])
+def test_missing_required_msg_data(dispatcher, msg_data):
+    message = form_message('k', 'code_execution')
+    message['msg_data'] = msg_data
+    assert dispatcher.validate(message) is None
+
+
+def test_unknown_type(dispatcher, caplog):
+    message = form_message('k', 'bogus')
+    assert dispatcher.validate(message) == 'bogus'
+
+    with caplog.at_level(logging.WARNING):
+        dispatcher.dispatch(message)
+
+    assert 'unknown type bogus' in caplog.text
+
+
+def test_register_message_handler():
+    kernel = Kernel('k', True, 15, 600, 2)
+
+    received = []
+    kernel.register_message_handler('custom', received.append, ['payload'])
+
+    assert kernel.dispatcher.validate(form_message('k', 'custom')) is None
+
+    message = form_message('k', 'custom', {'payload': 1})
+    assert kernel.dispatcher.validate(message) == 'custom'
+
+    kernel.process_message(message)
+    assert received == [message]
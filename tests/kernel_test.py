@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import pytest
+from datetime import datetime, timedelta
+from plutoid_kernel import kernel as kernel_module
+from plutoid_kernel.kernel import Kernel
+from plutoid_kernel.utils import form_message
+
+
+class Shutdown(Exception):
+    pass
+
+
+@pytest.fixture
+def kernel(monkeypatch):
+    monkeypatch.setattr(kernel_module, 'disconnected_time', lambda: 0)
+    kernel = Kernel('k', True, 15, 600, 2)
+
+    def shutdown():
+        raise Shutdown()
+
+    monkeypatch.setattr(kernel, 'shutdown', shutdown)
+    return kernel
+
+
+def test_ping_timeout(kernel):
+    kernel.kernel_state.last_ping_request_timestamp = datetime.now() - timedelta(seconds=31)
+
+    with pytest.raises(Shutdown):
+        kernel.validate_ping_timeout()
+
+
+def test_ping_timeout_ignores_broker_outage(kernel, monkeypatch):
+    kernel.kernel_state.last_ping_request_timestamp = datetime.now() - timedelta(seconds=60)
+    monkeypatch.setattr(kernel_module, 'disconnected_time', lambda: 50)
+
+    kernel.validate_ping_timeout()
+
+    monkeypatch.setattr(kernel_module, 'disconnected_time', lambda: 20)
+    with pytest.raises(Shutdown):
+        kernel.validate_ping_timeout()
+
+
+@pytest.mark.parametrize('chunks, lines', [
+    (['a\nb'], ['a', 'b']),
+    (['a\r\nb\r\n'], ['a', 'b']),
+    (['a\rb\n'], ['a', 'b']),
+    (['a\x0cb\x0bc d\n'], ['a\x0cb\x0bc d']),
+    (['\n\n'], ['', '']),
+    (['', 5, ['a']], []),
+])
+def test_buffer_stdin(kernel, chunks, lines):
+    for chunk in chunks:
+        kernel.kernel_state.buffer_stdin(chunk)
+    assert list(kernel.kernel_state.stdin_lines) == lines
+
+
+def test_buffer_stdin_stream(kernel):
+    state = kernel.kernel_state
+
+    for chunk in ['x', 'y\r', '\nz']:
+        state.buffer_stdin(chunk, eof=False)
+    assert list(state.stdin_lines) == ['xy']
+
+    state.buffer_stdin('', eof=True)
+    assert list(state.stdin_lines) == ['xy', 'z']
+
+
+def stdin_data(kernel, content, **msg_data):
+    msg_data['content'] = content
+    kernel.process_message(form_message('k', 'stdin_data', msg_data))
+
+
+def test_stdin_data_needs_running_code_execution(kernel):
+    stdin_data(kernel, 'a\n')
+    assert not kernel.kernel_state.stdin_lines
+
+    kernel.kernel_state.code_execution_msg_id = 'run-1'
+    kernel.kernel_state.mark_in_progress('code_execution')
+
+    stdin_data(kernel, 'b\n', in_response_to='run-0')
+    stdin_data(kernel, 'c\n', in_response_to='run-1')
+    stdin_data(kernel, 'd\n')
+    assert list(kernel.kernel_state.stdin_lines) == ['c', 'd']
+
+    kernel.kernel_state.reset_code_execution_state()
+    assert not kernel.kernel_state.stdin_lines
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+import pytest
+from plutoid_kernel import messaging
+
+
+NODE_IDS = {
+    ('a', 7711): 'aaaaaaaa0000',
+    ('b', 7712): 'bbbbbbbb0000',
+    ('c', 7713): 'cccccccc0000',
+}
+
+
+class FakeCluster(object):
+    def __init__(self):
+        self.up = set(NODE_IDS)
+        self.commands = []
+        self.jobs = []
+        self.connections = []
+        self.errors = {}
+
+
+class FakeConnectionPool(object):
+    def __init__(self):
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+class FakeRedis(object):
+    cluster = None
+
+    def __init__(self, host, port, socket_timeout=None, socket_connect_timeout=None):
+        self.server = (host, port)
+        self.socket_timeout = socket_timeout
+        self.socket_connect_timeout = socket_connect_timeout
+        self.connection_pool = FakeConnectionPool()
+        self.cluster.connections.append(self)
+
+    def execute_command(self, *args):
+        if self.server not in self.cluster.up:
+            raise ConnectionError('%s:%d is down' % self.server)
+
+        self.cluster.commands.append((self.server,) + args)
+
+        error = self.cluster.errors.get((self.server, args[0]))
+        if error:
+            raise error
+
+        if args[0] == 'HELLO':
+            return [1, NODE_IDS[self.server]] + [[node_id, host, port, 1]
+                for (host, port), node_id in sorted(NODE_IDS.items())]
+        if args[0] == 'GETJOB':
+            jobs, self.cluster.jobs = self.cluster.jobs, []
+            return jobs
+
+
+@pytest.fixture
+def cluster(monkeypatch):
+    cluster = FakeCluster()
+    monkeypatch.setattr(FakeRedis, 'cluster', cluster)
+    monkeypatch.setattr(messaging, 'Redis', FakeRedis)
+    monkeypatch.setattr(messaging.time, 'sleep', lambda seconds: None)
+    yield cluster
+    messaging.init([], messaging.DEFAULT_MAX_PENDING_MESSAGES)
+
+
+def sent_commands(cluster, command):
+    return [c for c in cluster.commands if c[1] == command]
+
+
+def test_connect_uses_timeouts(cluster):
+    messaging.init([('a', 7711)])
+
+    connection = cluster.connections[-1]
+    assert connection.socket_timeout == messaging.SOCKET_TIMEOUT
+    assert connection.socket_connect_timeout == messaging.CONNECT_TIMEOUT
+    assert messaging.SOCKET_TIMEOUT > messaging.MAX_GETJOB_TIMEOUT
+
+
+def test_failover_follows_configured_order(cluster):
+    cluster.up = set([('b', 7712), ('c', 7713)])
+    messaging.init([('a', 7711), ('b', 7712), ('c', 7713)])
+    assert messaging.connected_server == ('b', 7712)
+
+    cluster.up = set([('a', 7711), ('c', 7713)])
+    messaging.send_message('q', 'm')
+
+    assert messaging.connected_server == ('a', 7711)
+    assert sent_commands(cluster, 'ADDJOB')[-1][:3] == (('a', 7711), 'ADDJOB', 'q')
+
+
+def test_dead_connection_is_closed(cluster):
+    messaging.init([('a', 7711), ('b', 7712)])
+    dead_connection = cluster.connections[-1]
+
+    cluster.up.discard(('a', 7711))
+    messaging.get_messages('q', 1)
+    assert not messaging.is_connected()
+
+    messaging.get_messages('q', 1)
+    assert dead_connection.connection_pool.disconnected
+    assert messaging.connected_server == ('b', 7712)
+
+
+def test_rejected_message_is_dropped(cluster):
+    messaging.init([('a', 7711), ('b', 7712)])
+    cluster.errors[(('a', 7711), 'ADDJOB')] = messaging.ResponseError('ERR bad job')
+
+    messaging.send_message('q', 'm')
+
+    assert messaging.connected_server == ('a', 7711)
+    assert messaging.is_connected()
+    assert not messaging.pending_messages
+
+
+def test_transient_error_fails_over(cluster):
+    messaging.init([('a', 7711), ('b', 7712)])
+    cluster.errors[(('a', 7711), 'ADDJOB')] = messaging.ResponseError('NOREPL Not enough reachable nodes')
+
+    messaging.send_message('q', 'm')
+
+    assert messaging.connected_server == ('b', 7712)
+    assert sent_commands(cluster, 'ADDJOB')[-1][:4] == (('b', 7712), 'ADDJOB', 'q', 'm')
+    assert not messaging.pending_messages
+
+
+def test_flush_drops_rejected_messages(cluster):
+    cluster.up = set()
+    messaging.init([('a', 7711)])
+
+    messaging.send_message('q', '0')
+    messaging.send_message('q', '1')
+
+    cluster.up = set([('a', 7711)])
+    cluster.errors[(('a', 7711), 'ADDJOB')] = messaging.ResponseError('ERR bad job')
+    messaging.next_reconnect_time = 0
+    assert messaging.reconnect()
+
+    assert len(sent_commands(cluster, 'ADDJOB')) == 2
+    assert not messaging.pending_messages
+
+
+def test_disconnected_time(cluster, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(messaging.time, 'time', lambda: now[0])
+
+    messaging.init([('a', 7711)])
+    assert messaging.disconnected_time() == 0
+
+    cluster.up = set()
+    now[0] += 5
+    messaging.get_messages('q', 1)
+    now[0] += 20
+    assert messaging.disconnected_time() == 20
+
+    cluster.up = set([('a', 7711)])
+    messaging.next_reconnect_time = 0
+    assert messaging.reconnect()
+    now[0] += 30
+    assert messaging.disconnected_time() == 20
+
+
+def test_backoff_ceiling(cluster, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(messaging.time, 'time', lambda: now[0])
+    monkeypatch.setattr(messaging.random, 'uniform', lambda low, high: high)
+
+    cluster.up = set()
+    messaging.init([('a', 7711)])
+
+    delays = []
+    for _ in range(12):
+        assert not messaging.reconnect()
+        delays.append(messaging.next_reconnect_time - now[0])
+        assert not messaging.reconnect()
+        now[0] = messaging.next_reconnect_time
+
+    assert delays[0] == pytest.approx(messaging.RECONNECT_BASE_DELAY)
+    assert delays[1] == pytest.approx(2 * messaging.RECONNECT_BASE_DELAY)
+    assert max(delays) == pytest.approx(messaging.RECONNECT_MAX_DELAY)
+    assert delays[-1] == pytest.approx(messaging.RECONNECT_MAX_DELAY)
+
+
+def test_pending_messages_drop_oldest(cluster):
+    cluster.up = set()
+    messaging.init([('a', 7711)], max_pending_messages=3)
+
+    for i in range(5):
+        messaging.send_message('q', str(i))
+
+    assert list(messaging.pending_messages) == [('q', '2'), ('q', '3'), ('q', '4')]
+
+
+def test_flush_sends_acks_before_messages_in_order(cluster):
+    cluster.up = set()
+    messaging.init([('a', 7711)])
+
+    messaging.send_message('q', '0')
+    messaging.ack_message('D-aaaaaaaa-1-05a1')
+    messaging.send_message('q', '1')
+    messaging.ack_message('D-aaaaaaaa-2-05a1')
+
+    cluster.up = set([('a', 7711)])
+    messaging.next_reconnect_time = 0
+    messaging.send_message('q', '2')
+
+    flushed = [c[1:] for c in cluster.commands if c[1] in ('ACKJOB', 'ADDJOB')]
+    assert flushed[0] == ('ACKJOB', 'D-aaaaaaaa-1-05a1', 'D-aaaaaaaa-2-05a1')
+    assert [c[1:3] for c in flushed[1:]] == [('q', '0'), ('q', '1'), ('q', '2')]
+    assert not messaging.pending_messages
+    assert not messaging.pending_acks
+
+
+def queue_jobs(cluster, producer, count):
+    cluster.jobs += [['q', 'D-%s-%d-05a1' % (producer[:8], i), '{}'] for i in range(count)]
+
+
+def test_locality_switch(cluster):
+    messaging.init([('a', 7711), ('b', 7712)])
+    previous_connection = cluster.connections[-1]
+
+    queue_jobs(cluster, NODE_IDS[('b', 7712)], messaging.LOCALITY_CHECK_INTERVAL)
+    messaging.get_messages('q', 1)
+
+    assert messaging.connected_server == ('b', 7712)
+    assert previous_connection.connection_pool.disconnected
+
+
+def test_locality_ignores_unconfigured_nodes(cluster):
+    messaging.init([('a', 7711), ('b', 7712)])
+    connections = len(cluster.connections)
+
+    queue_jobs(cluster, NODE_IDS[('c', 7713)], messaging.LOCALITY_CHECK_INTERVAL)
+    messaging.get_messages('q', 1)
+
+    assert messaging.connected_server == ('a', 7711)
+    assert len(cluster.connections) == connections
+    assert not messaging.recent_job_producers
+
+    hellos = len(sent_commands(cluster, 'HELLO'))
+    queue_jobs(cluster, NODE_IDS[('c', 7713)], 5)
+    queue_jobs(cluster, NODE_IDS[('a', 7711)], messaging.LOCALITY_CHECK_INTERVAL - 5)
+    messaging.get_messages('q', 1)
+
+    assert len(sent_commands(cluster, 'HELLO')) == hellos
@@ -274,6 +274,96 @@ print(s)
     assert collected_messages['stdout'][0]['msg_data']['content'] == 'xyz\n'
 
 
+def test_prefetched_stdin(kernel_details):
+    kernel_id, kernel_proc = kernel_details
+    code = '''
+a = input()
+b = input()
+print(a + b)
+'''
+
+    message = form_message(kernel_id, 'code_execution', {'reverse_path': CLIENT_CHANNEL, 'code': code, 'stdin': 'x\ny\n'})
+    disque_client.add_job(kernel_id, json.dumps(message))
+
+    collected_messages = fetch_messages({'input_request': 1, 'stdout': 1, 'code_execution_complete': 1})
+    assert len(collected_messages['input_request']) == 0
+    assert len(collected_messages['stdout']) == 1
+    assert collected_messages['stdout'][0]['msg_data']['content'] == 'xy\n'
+
+
+def test_prefetched_stdin_prompt(kernel_details):
+    kernel_id, kernel_proc = kernel_details
+    code = '''
+s = input('Enter: ')
+print(s)
+'''
+
+    message = form_message(kernel_id, 'code_execution', {'reverse_path': CLIENT_CHANNEL, 'code': code, 'stdin': 'x\r\n'})
+    disque_client.add_job(kernel_id, json.dumps(message))
+
+    collected_messages = fetch_messages({'stdout': 1, 'code_execution_complete': 1})
+    assert len(collected_messages['stdout']) == 1
+    assert collected_messages['stdout'][0]['msg_data']['content'] == 'Enter: x\n'
+
+
+def test_non_string_stdin(kernel_details):
+    kernel_id, kernel_proc = kernel_details
+    code = '''print('ok')'''
+
+    message = form_message(kernel_id, 'code_execution', {'reverse_path': CLIENT_CHANNEL, 'code': code, 'stdin': 5})
+    disque_client.add_job(kernel_id, json.dumps(message))
+
+    collected_messages = fetch_messages({'stdout': 1, 'code_execution_complete': 1})
+    assert len(collected_messages['stdout']) == 1
+    assert collected_messages['stdout'][0]['msg_data']['content'] == 'ok\n'
+    assert len(collected_messages['code_execution_complete']) == 1
+
+
+def test_stdin_data(kernel_details):
+    kernel_id, kernel_proc = kernel_details
+    code = '''
+a = input()
+b = input()
+print(a + b)
+'''
+
+    message = form_message(kernel_id, 'code_execution', {'reverse_path': CLIENT_CHANNEL, 'code': code, 'stdin': 'x'})
+    disque_client.add_job(kernel_id, json.dumps(message))
+
+    collected_messages = fetch_messages({'input_request': 1})
+    assert len(collected_messages['input_request']) == 1
+
+    message = form_message(kernel_id, 'stdin_data', {'content': 'y\n'})
+    disque_client.add_job(kernel_id, json.dumps(message))
+
+    collected_messages = fetch_messages({'stdout': 1, 'code_execution_complete': 1})
+    assert len(collected_messages['stdout']) == 1
+    assert collected_messages['stdout'][0]['msg_data']['content'] == 'xy\n'
+
+
+def test_stdin_data_partial_lines(kernel_details):
+    kernel_id, kernel_proc = kernel_details
+    code = '''
+s = input()
+print(s)
+'''
+
+    message = form_message(kernel_id, 'code_execution', {'reverse_path': CLIENT_CHANNEL, 'code': code})
+    code_execution_msg_id = message['header']['msg_id']
+    disque_client.add_job(kernel_id, json.dumps(message))
+
+    collected_messages = fetch_messages({'input_request': 1})
+    assert len(collected_messages['input_request']) == 1
+
+    for content in ['x', 'y\n']:
+        message = form_message(kernel_id, 'stdin_data', {'content': content, 'in_response_to': code_execution_msg_id})
+        disque_client.add_job(kernel_id, json.dumps(message))
+
+    collected_messages = fetch_messages({'stdout': 1, 'code_execution_complete': 1})
+    assert len(collected_messages['stdout']) == 1
+    assert collected_messages['stdout'][0]['msg_data']['content'] == 'xy\n'
+
+
 def test_max_code_execution_time(kernel_details):
     kernel_id, kernel_proc = kernel_details
 